@@ -1,6 +1,55 @@
-from .pathmap import mirror_path, remove_extensions, remove_internal_extensions, nice_url
+# The `execution_rule` decorator shadows the submodule of the same name, so it
+# is bound eagerly (the submodule has no dependencies). Otherwise, importing
+# the submodule from elsewhere in the package would rebind the name.
 from .execution_rule import copy_file, execution_rule
-from .build_env import build
-from .jinja_utils import JinjaFile, jinja_env, markdown_filter, format_date, date_formatter
 
-mirror_file = (mirror_path, copy_file)
+# Public names are loaded lazily (PEP 562), from the submodule listed here,
+# so that `import jssg` stays cheap for short invocations. Submodules are
+# loaded with `__import__`, rather than importlib, so they are still reported
+# by `python -X importtime`.
+_exports = {
+    'mirror_path': 'pathmap',
+    'remove_extensions': 'pathmap',
+    'remove_internal_extensions': 'pathmap',
+    'nice_url': 'pathmap',
+    'build': 'build_env',
+    'plan': 'build_env',
+    'save_plan': 'build_env',
+    'load_plan': 'build_env',
+    'save_timings': 'build_env',
+    'load_timings': 'build_env',
+    'shard_files': 'build_env',
+    'collect_shard': 'build_env',
+    'merge_shard_data': 'build_env',
+    'build_shard': 'build_env',
+    'AssetPipeline': 'assets',
+    'JinjaFile': 'jinja_utils',
+    'jinja_env': 'jinja_utils',
+    'markdown_filter': 'jinja_utils',
+    'format_date': 'jinja_utils',
+    'date_formatter': 'jinja_utils',
+    'FragmentCache': 'jinja_cache',
+}
+
+_submodules = ('pathmap', 'build_env', 'assets', 'jinja_utils', 'jinja_cache')
+
+__all__ = ['copy_file', 'execution_rule', 'mirror_file'] + list(_exports)
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(_submodule(_exports[name]), name)
+    elif name == 'mirror_file':
+        value = (__getattr__('mirror_path'), copy_file)
+    elif name in _submodules:
+        value = _submodule(name)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    globals()[name] = value
+    return value
+
+def _submodule(name):
+    return __import__(name, globals(), fromlist=('__name__',), level=1)
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_submodules))
@@ -0,0 +1,152 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+
+from .execution_rule import ExecutionRule
+
+
+class AssetPipeline(ExecutionRule):
+    """Execution rule handling all matched static assets as a single batch.
+
+    During the first build phase, every file matched to the pipeline is only
+    recorded. The first time any of the resulting executions runs (or the
+    first time a template looks up an asset url), the whole batch is
+    processed at once:
+
+        1. every input is hashed by a pool of `workers` threads,
+        2. each distinct content is written once, and all other outputs with
+           identical content are hardlinked to it (falling back to a copy if
+           the file system does not support hardlinks),
+        3. if `fingerprint` is set, output names get the content hash inserted
+           before their suffix (e.g. img/logo.png -> img/logo.1a2b3c4d.png).
+
+    If `store` is given, it is a directory used as a content addressed store.
+    Each distinct content is written there once (under its hash), and all
+    outputs are hardlinked to the store. Since the store outlives a single
+    build, unchanged content is never copied again on subsequent builds.
+
+    If `manifest` is given, a json file of that name is written to the build
+    directory mapping each output path to its (possibly fingerprinted) path.
+    The same mapping is available to templates via `install`, which adds an
+    `asset_url` function to a jinja environment.
+    """
+    def __init__(self, fingerprint=False, store=None, manifest=None, workers=None, hash_length=8):
+        self.fingerprint = fingerprint
+        self.store = store
+        self.manifest_name = manifest
+        self.workers = workers
+        self.hash_length = hash_length
+
+        self.fs = None
+        self._pending = []
+        self._manifest = {}
+        self._processed = False
+
+    def __call__(self, fs, inf, outf):
+        self.fs = fs
+        self._pending.append((inf, outf))
+        self._processed = False
+        ex = lambda state: self.process()
+        return ex, dict(type='asset', data=(inf, outf))
+
+    def install(self, env, name='asset_url'):
+        """Add the `asset_url` lookup to the globals of jinja environment `env`."""
+        env.globals[name] = self.asset_url
+        return env
+
+    def asset_url(self, outf):
+        """Return the final path of output `outf`, relative to the build directory."""
+        self.process()
+        return self._manifest.get(outf, outf)
+
+    @property
+    def manifest(self):
+        """Mapping from each output path to the path actually written."""
+        self.process()
+        return dict(self._manifest)
+
+    def process(self):
+        """Process all pending assets. Does nothing if they are already processed."""
+        if self._processed:
+            return
+        self._processed = True
+
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        fs = self.fs
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            digests = list(pool.map(lambda p: _hash_file(fs.resolve_in(p[0])), pending))
+
+            # Group outputs by content, so that each content is written once.
+            groups = {}
+            for (inf, outf), digest in zip(pending, digests):
+                final = self._final_name(outf, digest)
+                self._manifest[outf] = final
+                groups.setdefault(digest, []).append((inf, final))
+
+            list(pool.map(lambda item: self._write_group(*item), groups.items()))
+
+        if self.manifest_name is not None:
+            fs.write(self.manifest_name, json.dumps(self._manifest, indent=2, sort_keys=True))
+
+    def _final_name(self, outf, digest):
+        if not self.fingerprint:
+            return outf
+        path = pathlib.PurePosixPath(outf)
+        return path.with_name("{}.{}{}".format(path.stem, digest[:self.hash_length], path.suffix)).as_posix()
+
+    def _write_group(self, digest, items):
+        fs = self.fs
+        if self.store is not None:
+            source = pathlib.Path(self.store, digest[:2], digest)
+            if not source.is_file():
+                source.parent.mkdir(parents=True, exist_ok=True)
+                _atomic_copy(fs.resolve_in(items[0][0]), source)
+            links = items
+        else:
+            # Outputs may be hardlinks left over from a previous build, so
+            # they are replaced rather than written through.
+            (inf, outf), links = items[0], items[1:]
+            fs.ensure_dir(outf)
+            source = fs.resolve_out(outf)
+            if os.path.lexists(source):
+                os.remove(source)
+            shutil.copyfile(fs.resolve_in(inf), source)
+
+        for _, outf in links:
+            fs.ensure_dir(outf)
+            _link_or_copy(source, fs.resolve_out(outf))
+
+
+def _hash_file(path, chunk_size=1 << 16):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _atomic_copy(src, dst):
+    # Copy via a temporary file in the same directory, so that an interrupted
+    # copy (or another build sharing the store) never sees a partial file.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), prefix='.tmp-')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def _link_or_copy(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
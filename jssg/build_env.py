@@ -1,12 +1,16 @@
 import fnmatch
+import json
 import pathlib
 import os
+import pickle
 import shutil
+import time
+import zlib
 
 from .execution_rule import ExecutionRule
 
 
-def build(indir, outdir, rules, files="", filesys=None, listeners=None):
+def build(indir, outdir, rules, files="", filesys=None, listeners=None, plan=None, progress=None, resume=False, timings=None):
     """Build files in `indir` to `outdir` given a rule matching list `rules`.
 
     Arguments
@@ -17,6 +21,10 @@ def build(indir, outdir, rules, files="", filesys=None, listeners=None):
         files : (string or list) : files to process (default: all in indir)
         filesys : (FileSystem object)
         listeners : (Map[string, Object]) Objects with `on_data_return` and/or `before_execute` methods
+        plan : (dict) a plan produced by `plan` to execute, instead of matching `files`
+        progress : (string) path of a log, to which each completed input file is appended
+        resume : (bool) skip input files already completed in the `progress` log
+        timings : (dict) if given, execution times (in seconds) are stored here, per input file
 
     The `rules` list is a list or tuple of tuples taking the form
         (MATCH_RULE, (PATHMAP, EXECUTIONRULE/FILEMAP))
@@ -43,20 +51,260 @@ def build(indir, outdir, rules, files="", filesys=None, listeners=None):
     Listeners allow capture/observation of data as it gets processed via `on_data_return`,
     allowing aggregation, which can then be injected into the executions via the state
     parameter.
+
+    If a `plan` is passed, the files and rules it lists are used directly, with
+    no walking of `indir` or rule matching (`rules` must be the same list the plan
+    was made with, and a ValueError is raised if an entry's rule has changed).
+
+    If a `progress` log is passed, each input file is appended to it once its
+    execution has returned (the log is started afresh, unless resuming). With
+    `resume`, the executions of the input files in the log are skipped, so that
+    a build that crashed partway through the execution phase can be picked up
+    where it stopped. An execution interrupted partway is not in the log, and
+    so is run again. Note that the first phase is always run for every file,
+    so that listeners see all the data.
     """
 
+    if resume and progress is None:
+        raise ValueError("Argument `progress` is required to resume a build")
+
+    if filesys is None:
+        filesys=FileSys(indir, outdir)
+
+    if plan is not None:
+        rf_pairs = _plan_rule_file_pairs(rules, plan)
+    else:
+        if isinstance(files, str):
+            files = filesys.list_all_files(files)
+        rf_pairs = match_files_to_rules(rules, files)
+
+    if progress is not None or timings is not None:
+        log = None
+        if progress is not None:
+            log = _ProgressLog(progress, resume)
+        rf_pairs = ((_track_rule(rule, timings, log), f) for rule, f in rf_pairs)
+
+    exec_state, executions = evaluate_rules(filesys, rf_pairs, listeners)
+
+    for ex in executions:
+        ex(exec_state)
+
+def plan(indir, outdir, rules, files="", filesys=None, timings=None):
+    """Compute what `build` would do, without doing it.
+
+    Only the rule matching and path maps are run. The result is a dict with
+    the time the plan was `created`, and a list of `entries`, one per file
+    that would be built, with keys
+        input : the input file name
+        rule : the index of the matched rule in `rules`
+        match : the MATCH_RULE of that rule
+        output : the output file name
+        up_to_date : whether the output exists and is newer than the input
+        estimated_cost : the execution time of the input in `timings`, or None
+
+    `timings` are as recorded by a previous `build` (and saved with `save_timings`,
+    then loaded with `load_timings`). The plan can be saved with `save_plan`,
+    and passed back to `build` to execute it.
+    """
     if filesys is None:
         filesys=FileSys(indir, outdir)
 
     if isinstance(files, str):
         files = filesys.list_all_files(files)
 
-    rf_pairs = match_files_to_rules(rules, files)
-    exec_state, executions = evaluate_rules(filesys, rf_pairs, listeners)
+    if timings is None:
+        timings = {}
+
+    entries = []
+    for f in files:
+        index = _first_matching_rule_index(rules, f)
+        if index is None or rules[index][1] is None:
+            continue
+        match, (pm, _) = rules[index]
+        outf = pm(f)
+        entries.append(dict(input=f, rule=index, match=match, output=outf,
+            up_to_date=filesys.is_up_to_date(f, outf), estimated_cost=timings.get(f)))
+
+    return dict(created=time.time(), entries=entries)
+
+def save_plan(plan, fn):
+    """Save a plan produced by `plan` as json to file `fn`."""
+    with open(fn, 'w', encoding='utf-8') as f:
+        json.dump(plan, f, indent=2)
+
+def load_plan(fn):
+    """Load a plan saved with `save_plan`."""
+    with open(fn, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_timings(timings, fn):
+    """Save the `timings` recorded by `build` as json to file `fn`."""
+    with open(fn, 'w', encoding='utf-8') as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+
+def load_timings(fn):
+    """Load timings saved with `save_timings`, for use by `plan`."""
+    with open(fn, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _plan_rule_file_pairs(rules, plan):
+    # Every entry is checked before any is returned, so that a stale plan
+    # is rejected before phase one has run for any file.
+    pairs = []
+    for entry in plan['entries']:
+        index = entry['rule']
+        if not 0 <= index < len(rules):
+            raise ValueError("Plan entry for {!r} refers to rule {}, but there are only {} rules"
+                    .format(entry['input'], index, len(rules)))
+        match, result = rules[index]
+        if _normalize_match(match) != _normalize_match(entry['match']) or result is None:
+            raise ValueError("Plan entry for {!r} expects rule {} to match {!r}, not {!r}"
+                    .format(entry['input'], index, entry['match'], match))
+        _, rule = result
+        pm = lambda f, outf=entry['output']: outf
+        pairs.append(((pm, rule), entry['input']))
+    return pairs
+
+def _normalize_match(match):
+    # Saving a plan as json turns the tuples of a MATCH_RULE into lists
+    if isinstance(match, str):
+        return match
+    return [_normalize_match(m) for m in match]
+
+def _track_rule(rule, timings, log):
+    # Files with no matching rule (or a None rule) are passed through as is
+    if rule is None:
+        return None
+    pm, rule = rule
+    return pm, _TrackedRule(rule, timings, log)
+
+class _TrackedRule(ExecutionRule):
+    # Wraps an execution rule, recording the time taken by its executions,
+    # and skipping/logging them according to the progress log.
+    def __init__(self, rule, timings, log):
+        self.rule = ExecutionRule.wrap(rule)
+        self.timings = timings
+        self.log = log
+
+    def __call__(self, fs, inf, outf):
+        ex, data = self.rule(fs, inf, outf)
+
+        def tracked(state):
+            if self.log is not None and inf in self.log:
+                return
+            start = time.perf_counter()
+            ex(state)
+            if self.timings is not None:
+                self.timings[inf] = time.perf_counter() - start
+            if self.log is not None:
+                self.log.add(inf)
+
+        return tracked, data
+
+class _ProgressLog:
+    # Append only log of completed input files, one json string per line.
+    # A line cut short by a crash fails to parse, and is ignored.
+    def __init__(self, fn, resume):
+        self.fn = fn
+        self.done = set()
+        if resume and os.path.exists(fn):
+            with open(fn, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line))
+                    except ValueError:
+                        pass
+        else:
+            open(fn, 'w', encoding='utf-8').close()
+
+    def __contains__(self, inf):
+        return inf in self.done
+
+    def add(self, inf):
+        self.done.add(inf)
+        with open(self.fn, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(inf) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+# Sharded builds split the two phases across processes/machines:
+# 1) each shard runs phase one on its files, and saves the data returns
+# 2) the data from all shards is merged, and passed through the listeners
+#    by each shard, which then executes only its own outputs.
+def shard_files(files, shard, num_shards):
+    """Deterministically select the files in `files` belonging to `shard` (of `num_shards`).
+
+    Files are assigned by a hash of their name, so the partition does not depend
+    on the order in which the files are listed.
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError("shard must be in [0, {})".format(num_shards))
+    for f in files:
+        if zlib.crc32(f.encode('utf-8')) % num_shards == shard:
+            yield f
+
+def collect_shard(indir, outdir, rules, shard, num_shards, datafile, files="", filesys=None):
+    """Run phase one of the build for a single shard, saving the data returns to `datafile`.
+
+    Arguments are as for `build`, with `shard`/`num_shards` selecting the files
+    to process (see `shard_files`). The data returns are pickled to `datafile`,
+    and so must be picklable (e.g. file maps must be module level functions
+    rather than lambdas). The data files of all shards are combined with
+    `merge_shard_data`.
+    """
+    if filesys is None:
+        filesys=FileSys(indir, outdir)
 
+    records, _ = _evaluate_shard(filesys, rules, files, shard, num_shards)
+    with open(datafile, 'wb') as f:
+        pickle.dump(records, f)
+
+def merge_shard_data(datafiles):
+    """Load and merge the data files written by `collect_shard`.
+
+    Returns the list of (inf, outf, data) of all shards, sorted by input file
+    name, so the order is the same however each shard listed its files.
+    """
+    records = []
+    for fn in datafiles:
+        with open(fn, 'rb') as f:
+            records.extend(pickle.load(f))
+    records.sort(key=lambda r: r[0])
+    return records
+
+def build_shard(indir, outdir, rules, shard, num_shards, datafiles, files="", filesys=None, listeners=None):
+    """Execute the outputs of a single shard, given the data files of all shards.
+
+    The listeners are notified of the merged data returns of all shards
+    (see `merge_shard_data`), so that every shard computes the same
+    exec_state. Note that listeners see the files in sorted order, rather
+    than the directory order of an unsharded build. Phase one is then re-run
+    for this shard only, in order to recover its executions, which are called
+    with that state.
+    """
+    if filesys is None:
+        filesys=FileSys(indir, outdir)
+
+    exec_state = {}
+    if listeners:
+        exec_state = _notify_listeners(merge_shard_data(datafiles), listeners)
+
+    _, executions = _evaluate_shard(filesys, rules, files, shard, num_shards)
     for ex in executions:
         ex(exec_state)
 
+def _evaluate_shard(fs, rules, files, shard, num_shards):
+    if isinstance(files, str):
+        files = fs.list_all_files(files)
+
+    own = shard_files(files, shard, num_shards)
+
+    records, executions = [], []
+    for record, ex in _lazy_evaluate_rules(fs, match_files_to_rules(rules, own)):
+        records.append(record)
+        executions.append(ex)
+    return records, executions
+
 # Given matching rules, compute
 # a) A list of (inf, outf, data)
 # b) executions
@@ -127,6 +375,12 @@ def _first_matching_rule(rules, path, default=None):
             return result
     return default
 
+def _first_matching_rule_index(rules, path):
+    for i, (rule, _) in enumerate(rules):
+        if _match_single_rule(rule, path):
+            return i
+    return None
+
 def _match_single_rule(rule, path):
     if isinstance(rule, str):
         result = fnmatch.fnmatch(path, rule)
@@ -181,7 +435,24 @@ class FileSys:
         outf = self.resolve_out(outf)
         loc = pathlib.Path(outf).parent
         if not loc.is_dir():
-            loc.mkdir(parents=True)
+            loc.mkdir(parents=True, exist_ok=True)
+
+    def in_mtime(self, inf):
+        return _mtime(self.resolve_in(inf))
+
+    def out_mtime(self, outf):
+        return _mtime(self.resolve_out(outf))
+
+    def is_up_to_date(self, inf, outf):
+        """Whether output `outf` exists, and was modified after input `inf`."""
+        out_time = self.out_mtime(outf)
+        return out_time is not None and out_time >= self.in_mtime(inf)
 
     def list_all_files(self, d=""):
         return list_all_files(self.resolve_in(d), rel_to=self.indir)
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
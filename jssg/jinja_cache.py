@@ -0,0 +1,164 @@
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import jinja2
+import jinja2.ext
+import markupsafe
+
+
+class FragmentCache:
+    """Bounded store of rendered template fragments.
+
+    Holds up to `maxsize` fragments in memory, discarding the least recently
+    used first. The in-memory store is only valid for a single build. If an
+    environment is reused across builds in one process (e.g. when watching
+    for changes), pass the cache to `build` as a listener, e.g.
+        build(..., listeners={'fragment_cache': env.fragment_cache})
+    which clears it before each execution phase, or call `clear` yourself.
+
+    If `store` is given, it is a directory in which every rendered fragment is
+    also saved, so that fragments survive across builds. Saved fragments are
+    keyed by the source of the cached block, the key given to the `cache` tag,
+    and the sources of all templates the env's loader can list, so editing
+    any template (e.g. an included nav.html) invalidates them. Anything else
+    a fragment depends on, such as site data, must be captured by the key.
+
+    Hashable keys are compared as dict keys, and unhashable keys by their json
+    serialization (a TypeError is raised if they have none). Keys saved in the
+    persistent store must be strings, ints, or tuples of those.
+    """
+    def __init__(self, maxsize=1024, store=None):
+        self.maxsize = maxsize
+        self.store = store
+        self._fragments = collections.OrderedDict()
+        self._templates_digest = None
+
+    def get_or_render(self, key, render, version=''):
+        """Return the fragment for `key`, calling `render()` to produce it if not cached.
+
+        `version` is added to the key in the persistent store only, to invalidate
+        saved fragments when something they depend on changes.
+        """
+        memory_key = _memory_key(key)
+        if memory_key in self._fragments:
+            self._fragments.move_to_end(memory_key)
+            return self._fragments[memory_key]
+
+        path = self._store_path(key, version)
+        if path is not None and path.is_file():
+            value = path.read_text(encoding='utf-8')
+        else:
+            value = render()
+            if path is not None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                _atomic_write(path, value)
+
+        self._fragments[memory_key] = value
+        if len(self._fragments) > self.maxsize:
+            self._fragments.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Empty the in-memory store (the persistent store is kept)."""
+        self._fragments.clear()
+        self._templates_digest = None
+
+    def templates_digest(self, env):
+        """Digest of the sources of the templates of `env`, computed once until `clear`."""
+        if self._templates_digest is None:
+            self._templates_digest = _templates_digest(env)
+        return self._templates_digest
+
+    def before_execute(self):
+        # As a build listener, start each execution phase with an empty store
+        self.clear()
+
+    def _store_path(self, key, version):
+        if self.store is None:
+            return None
+        if not _is_persistable(key):
+            raise TypeError("Key {!r} cannot be saved to a persistent fragment store; "
+                    "use strings, ints, or tuples of those".format(key))
+        digest = hashlib.sha256(json.dumps([version, key]).encode('utf-8')).hexdigest()
+        return pathlib.Path(self.store, digest[:2], digest)
+
+def _templates_digest(env):
+    # Loaders which cannot list their templates (e.g. FunctionLoader) are
+    # not covered, and give an empty digest.
+    try:
+        names = env.list_templates()
+    except TypeError:
+        return ''
+    h = hashlib.sha256()
+    for name in sorted(names):
+        source, _, _ = env.loader.get_source(env, name)
+        h.update(json.dumps([name, source]).encode('utf-8'))
+    return h.hexdigest()
+
+def _atomic_write(path, s):
+    # Write via a temporary file in the same directory, so that an interrupted
+    # write (or another build sharing the store) never leaves a partial file.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(s)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def _memory_key(key):
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        pass
+    try:
+        # Tagged, so it cannot equal a hashable key
+        return ('json', json.dumps(key, sort_keys=True))
+    except TypeError:
+        raise TypeError("Cache key {!r} is neither hashable nor json serializable".format(key))
+
+def _is_persistable(key):
+    if isinstance(key, tuple):
+        return all(_is_persistable(k) for k in key)
+    return isinstance(key, (str, int))
+
+class FragmentCacheExtension(jinja2.ext.Extension):
+    """Jinja extension adding the `{% cache key %}...{% endcache %}` tag.
+
+    The body of the tag is rendered once per distinct `key`, and reused
+    wherever the same block is rendered with the same key, including from
+    other templates. Rendered fragments are kept in `env.fragment_cache`.
+    """
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = parser.parse_expression()
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+
+        # Identify the block by its contents, as page templates are often
+        # loaded from strings, and so have no name to tell them apart.
+        fragment = hashlib.sha256(repr(body).encode('utf-8')).hexdigest()
+        call = self.call_method('_render_fragment', [jinja2.nodes.Const(fragment), key])
+        return jinja2.nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, fragment, key, caller):
+        # Undefined keys would all share a single fragment, so they are an
+        # error. str() raises the env's own error first, if it is strict.
+        if isinstance(key, jinja2.Undefined):
+            str(key)
+            raise jinja2.UndefinedError("The key of a cache tag is undefined")
+        cache = self.environment.fragment_cache
+        version = cache.templates_digest(self.environment) if cache.store is not None else ''
+        # The fragment is rendered template output, so it is never escaped again
+        return markupsafe.Markup(cache.get_or_render((fragment, key), caller, version))
@@ -1,6 +1,17 @@
+import functools
+import sys
+
 from .execution_rule import ExecutionRule
 
 
+# Heavy dependencies are imported on first use, and cached thereafter, so that
+# they cost nothing at import time, and only a cache lookup in hot filters.
+@functools.lru_cache(maxsize=None)
+def _module(name):
+    __import__(name)
+    return sys.modules[name]
+
+
 class _RendererImpl:
     def __init__(self, name=None, load_file=None, create_state=None, obj=None):
         self._name = name
@@ -80,7 +91,7 @@ class JinjaFile(ExecutionRule):
         return self.renderer()(fs, inf, outf)
 
 # Code for configuring libs, like the jinja_environment
-def jinja_env(search_paths=(), prefix_paths=(), additional_loaders=None, filters=None, support_rss=True, rss_name="builtin/rss_base.xml"):
+def jinja_env(search_paths=(), prefix_paths=(), additional_loaders=None, filters=None, support_rss=True, rss_name="builtin/rss_base.xml", fragment_cache=True):
     """Initialize a jinja env that searches all load_paths for templates.
 
     builtin templates can also be found under builtin/
@@ -93,8 +104,15 @@ def jinja_env(search_paths=(), prefix_paths=(), additional_loaders=None, filters
     to be found, you must use the name 'layouts/a'. To use a prefix other than the
     full directory path, use a tuple (path, prefix). Continuing the example,
     if ('layouts', 'x') is is prefix_paths, then the template is found via 'x/a'.
+
+    fragment_cache enables the `{% cache key %}...{% endcache %}` tag, which renders
+    its body once per key, rather than once per page. Pass a FragmentCache to
+    control its size or persist fragments across builds, or False to disable it.
+    The cache is kept in `env.fragment_cache`, and is only valid for one build:
+    if the env is reused for several builds, pass `env.fragment_cache` to `build`
+    as a listener (which clears it), or call `env.fragment_cache.clear()` between them.
     """
-    import jinja2
+    jinja2 = _module('jinja2')
 
     def normalize_prefix_paths(p):
         for tup in p:
@@ -131,7 +149,15 @@ def jinja_env(search_paths=(), prefix_paths=(), additional_loaders=None, filters
 
     loader = jinja2.ChoiceLoader([user_loader, user_prefix_loader]+additional_loaders)
 
-    jinja_env = jinja2.Environment(loader=loader, undefined=jinja2.StrictUndefined)
+    extensions = []
+    if fragment_cache:
+        from .jinja_cache import FragmentCacheExtension
+        extensions.append(FragmentCacheExtension)
+
+    jinja_env = jinja2.Environment(loader=loader, undefined=jinja2.StrictUndefined, extensions=extensions)
+
+    if fragment_cache and fragment_cache is not True:
+        jinja_env.fragment_cache = fragment_cache
 
     if filters:
         jinja_env.filters.update(filters)
@@ -139,7 +165,7 @@ def jinja_env(search_paths=(), prefix_paths=(), additional_loaders=None, filters
     return jinja_env
 
 def markdown_filter(extensions=None, extension_configs=None):
-    import markdown
+    markdown = _module('markdown')
     mdfilter = lambda x: markdown.markdown(x, extensions=extensions, extension_configs=extension_configs)
     return mdfilter
 
@@ -166,16 +192,12 @@ _rss_base_src = """
 
 def rss_date(x):
     """Format a datestr into a format acceptable for RSS"""
-    import dateutil.parser
-    import email.utils
-
     if isinstance(x, str):
-        x = dateutil.parser.parse(x)
-    return email.utils.format_datetime(x)
+        x = _module('dateutil.parser').parse(x)
+    return _module('email.utils').format_datetime(x)
 
 def rss_loader(name='builtin/rss_base.xml'):
-    import jinja2
-    return jinja2.DictLoader({name: _rss_base_src})
+    return _module('jinja2').DictLoader({name: _rss_base_src})
 
 def date_formatter(format_str='%B %d, %Y'):
     return lambda x: format_date(x, format_str)
@@ -183,7 +205,6 @@ def date_formatter(format_str='%B %d, %Y'):
 
 def format_date(x, format_str):
     """Format a datestr with a given format string"""
-    import dateutil.parser
     if isinstance(x, str):
-        x = dateutil.parser.parse(x)
+        x = _module('dateutil.parser').parse(x)
     return x.strftime(format_str)
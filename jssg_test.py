@@ -1,4 +1,14 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
+import jinja2
 from jinja2 import Environment
 
 import jssg as jssg
@@ -193,4 +203,386 @@ class TestOtherOperations(unittest.TestCase):
         self.assertEqual(3, jssg.first_matching_rule(rules, 'b/c/x.abc'))
         self.assertIs(None, jssg.first_matching_rule(rules, 'totally_unrelated_file'))
 
+class SourceTreeTestCase(unittest.TestCase):
+    """Base for tests building a real source tree, in a temporary directory."""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.indir = os.path.join(self.tmp.name, 'src')
+        self.outdir = os.path.join(self.tmp.name, 'build')
+        os.makedirs(self.indir)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_files(self, files):
+        """Write {name: content} to the source tree. Content is bytes or text."""
+        for name, content in files.items():
+            path = pathlib.Path(self.indir, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if isinstance(content, bytes):
+                path.write_bytes(content)
+            else:
+                path.write_text(content)
+
+class TestAssetPipeline(SourceTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_files({'a/logo.png': b'logo', 'b/logo.png': b'logo', 'c/other.png': b'other'})
+
+    def build(self, assets):
+        jssg.build(self.indir, self.outdir, [('*.png', (jssg.mirror_path, assets))])
+
+    def test_duplicates_are_linked(self):
+        self.build(jssg.AssetPipeline())
+        a = os.stat(os.path.join(self.outdir, 'a/logo.png'))
+        b = os.stat(os.path.join(self.outdir, 'b/logo.png'))
+        self.assertTrue(os.path.samestat(a, b))
+        with open(os.path.join(self.outdir, 'c/other.png'), 'rb') as f:
+            self.assertEqual(b'other', f.read())
+
+    def test_fingerprint_and_manifest(self):
+        assets = jssg.AssetPipeline(fingerprint=True, manifest='manifest.json')
+        self.build(assets)
+        digest = hashlib.sha256(b'logo').hexdigest()[:8]
+        self.assertEqual('a/logo.{}.png'.format(digest), assets.asset_url('a/logo.png'))
+        self.assertTrue(os.path.isfile(os.path.join(self.outdir, 'a/logo.{}.png'.format(digest))))
+        with open(os.path.join(self.outdir, 'manifest.json')) as f:
+            self.assertEqual(assets.manifest, json.load(f))
+
+        env = assets.install(Environment())
+        self.assertEqual(assets.asset_url('c/other.png'),
+                env.from_string("{{ asset_url('c/other.png') }}").render())
+
+    def test_store(self):
+        store = os.path.join(self.tmp.name, 'store')
+        self.build(jssg.AssetPipeline(store=store))
+        stored = list(jssg.build_env.list_all_files(store))
+        self.assertEqual(2, len(stored))
+        digest = hashlib.sha256(b'logo').hexdigest()
+        with open(os.path.join(store, digest[:2], digest), 'rb') as f:
+            self.assertEqual(b'logo', f.read())
+
+    def test_store_copy_is_atomic(self):
+        store = os.path.join(self.tmp.name, 'store')
+        src = os.path.join(self.indir, 'a/logo.png')
+        dst = os.path.join(store, 'blob')
+        os.makedirs(store)
+        with unittest.mock.patch('shutil.copyfile', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                jssg.assets._atomic_copy(src, dst)
+        self.assertEqual([], os.listdir(store))
+
+
+class _ListFiles:
+    def __init__(self):
+        self.files = []
+
+    def on_data_return(self, inf, outf, data):
+        self.files.append(inf)
+
+    def before_execute(self):
+        return sorted(self.files)
+
+@jssg.execution_rule
+def _write_index(fs, inf, outf):
+    return (lambda state: fs.write(outf, ' '.join(state['files']))), None
+
+_shard_rules = [('index.html', (jssg.mirror_path, _write_index)), ('*', jssg.mirror_file)]
+
+def _collect_shard(indir, outdir, shard, datafile):
+    jssg.collect_shard(indir, outdir, _shard_rules, shard, 2, datafile)
+
+def _build_shard(indir, outdir, shard, datafiles):
+    jssg.build_shard(indir, outdir, _shard_rules, shard, 2, datafiles,
+            listeners={'files': _ListFiles()})
+
+class TestShardedBuild(SourceTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.names = ['index.html'] + ['f{}.txt'.format(i) for i in range(20)]
+        self.write_files({name: name for name in self.names})
+
+    def test_shard_files_partition(self):
+        shards = [list(jssg.shard_files(self.names, i, 3)) for i in range(3)]
+        self.assertEqual(sorted(self.names), sorted(sum(shards, [])))
+        self.assertEqual(shards[1], list(jssg.shard_files(reversed(self.names), 1, 3))[::-1])
+
+    def test_merge_order_is_by_input(self):
+        datafiles = [os.path.join(self.tmp.name, 'shard{}.pickle'.format(i)) for i in range(2)]
+        for i, datafile in enumerate(datafiles):
+            # Each shard lists the files in a different order
+            files = self.names if i == 0 else self.names[::-1]
+            jssg.collect_shard(self.indir, self.tmp.name, _shard_rules, i, 2, datafile, files=files)
+        merged = jssg.merge_shard_data(datafiles)
+        self.assertEqual(sorted(self.names), [inf for inf, _, _ in merged])
+
+    def test_sharded_build_matches_build(self):
+        full = os.path.join(self.tmp.name, 'full')
+        jssg.build(self.indir, full, _shard_rules, listeners={'files': _ListFiles()})
+
+        outdirs = [os.path.join(self.tmp.name, 'out{}'.format(i)) for i in range(2)]
+        datafiles = [os.path.join(self.tmp.name, 'shard{}.pickle'.format(i)) for i in range(2)]
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            list(pool.map(_collect_shard, [self.indir]*2, outdirs, range(2), datafiles))
+            list(pool.map(_build_shard, [self.indir]*2, outdirs, range(2), [datafiles]*2))
+
+        merged = {}
+        for outdir in outdirs:
+            for f in jssg.build_env.list_all_files(outdir):
+                self.assertNotIn(f, merged)
+                merged[f] = pathlib.Path(outdir, f).read_text()
+        expected = {f: pathlib.Path(full, f).read_text() for f in jssg.build_env.list_all_files(full)}
+        self.assertEqual(expected, merged)
+
+
+class TestBuildPlan(SourceTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write_files({name: name for name in ('a.txt', 'b/c.txt', 'd.skip')})
+        self.rules = [('*.skip', None), ('*.txt', (jssg.remove_extensions, jssg.copy_file))]
+
+    def test_plan_does_not_build(self):
+        plan = jssg.plan(self.indir, self.outdir, self.rules, timings={'a.txt': 0.5})
+        entries = sorted(plan['entries'], key=lambda e: e['input'])
+        self.assertEqual(['a.txt', 'b/c.txt'], [e['input'] for e in entries])
+        self.assertEqual(['a', 'b/c'], [e['output'] for e in entries])
+        self.assertEqual([1, 1], [e['rule'] for e in entries])
+        self.assertEqual([False, False], [e['up_to_date'] for e in entries])
+        self.assertEqual([0.5, None], [e['estimated_cost'] for e in entries])
+        self.assertFalse(os.path.exists(self.outdir))
+
+        jssg.build(self.indir, self.outdir, self.rules)
+        plan = jssg.plan(self.indir, self.outdir, self.rules)
+        self.assertTrue(all(e['up_to_date'] for e in plan['entries']))
+
+    def test_build_from_saved_plan(self):
+        fn = os.path.join(self.tmp.name, 'plan.json')
+        jssg.save_plan(jssg.plan(self.indir, self.outdir, self.rules, files=['a.txt']), fn)
+
+        timings = {}
+        jssg.build(self.indir, self.outdir, self.rules, plan=jssg.load_plan(fn), timings=timings)
+        self.assertEqual(['a'], list(jssg.build_env.list_all_files(self.outdir)))
+        self.assertEqual(['a.txt'], list(timings))
+
+    def test_stale_plan_is_rejected(self):
+        fn = os.path.join(self.tmp.name, 'plan.json')
+        self.rules[0] = (('*.skip', '*.old'), None)
+        jssg.save_plan(jssg.plan(self.indir, self.outdir, self.rules), fn)
+        plan = jssg.load_plan(fn)
+
+        # Tuples in the rules compare equal to the lists saved in json
+        jssg.build(self.indir, self.outdir, self.rules, plan=plan)
+
+        with self.assertRaises(ValueError):
+            jssg.build(self.indir, self.outdir, self.rules[::-1], plan=plan)
+        with self.assertRaises(ValueError):
+            jssg.build(self.indir, self.outdir, self.rules[:1], plan=plan)
+
+    def test_stale_plan_has_no_side_effects(self):
+        calls = []
+        @jssg.execution_rule
+        def record(fs, inf, outf):
+            calls.append(inf)
+            return (lambda state: None), None
+
+        rules = [('*.skip', None), ('a.txt', (jssg.mirror_path, record)), ('*.txt', (jssg.mirror_path, record))]
+        plan = jssg.plan(self.indir, self.outdir, rules)
+        # Only the entry of b/c.txt is stale
+        rules[2] = ('b/*.txt', rules[2][1])
+        with self.assertRaises(ValueError):
+            jssg.build(self.indir, self.outdir, rules, plan=plan)
+        self.assertEqual([], calls)
+
+    def test_estimates_from_saved_timings(self):
+        fn = os.path.join(self.tmp.name, 'timings.json')
+        timings = {}
+        jssg.build(self.indir, self.outdir, self.rules, timings=timings)
+        jssg.save_timings(timings, fn)
+
+        plan = jssg.plan(self.indir, self.outdir, self.rules, timings=jssg.load_timings(fn))
+        costs = {e['input']: e['estimated_cost'] for e in plan['entries']}
+        self.assertEqual(timings, costs)
+
+    def test_timings_with_skipped_files(self):
+        pathlib.Path(self.indir, 'unmatched.dat').write_text('x')
+        timings = {}
+        jssg.build(self.indir, self.outdir, self.rules, timings=timings)
+        self.assertEqual(['a.txt', 'b/c.txt'], sorted(timings))
+
+    def test_resume(self):
+        progress = os.path.join(self.tmp.name, 'progress.log')
+        plan = jssg.plan(self.indir, self.outdir, self.rules)
+
+        # The build crashes partway through writing b/c
+        def crashing_copy(fs, inf, outf):
+            if inf == 'b/c.txt':
+                fs.write(outf, 'trunc')
+                raise KeyboardInterrupt
+            fs.write(outf, 'first build')
+        rules = [self.rules[0], ('*.txt', (jssg.remove_extensions, crashing_copy))]
+        with self.assertRaises(KeyboardInterrupt):
+            jssg.build(self.indir, self.outdir, rules, plan=plan, progress=progress)
+
+        jssg.build(self.indir, self.outdir, self.rules, plan=plan, progress=progress, resume=True)
+        self.assertEqual('first build', pathlib.Path(self.outdir, 'a').read_text())
+        self.assertEqual('b/c.txt', pathlib.Path(self.outdir, 'b/c').read_text())
+
+        # Without resume, the log is started afresh
+        jssg.build(self.indir, self.outdir, self.rules, plan=plan, progress=progress)
+        self.assertEqual('a.txt', pathlib.Path(self.outdir, 'a').read_text())
+
+    def test_resume_requires_progress(self):
+        with self.assertRaises(ValueError):
+            jssg.build(self.indir, self.outdir, self.rules, resume=True)
+
+
+class TestFragmentCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def nav(self, section):
+        self.calls.append(section)
+        return 'nav:' + section
+
+    def env(self, fragment_cache=True):
+        env = jssg.jinja_env(support_rss=False, fragment_cache=fragment_cache)
+        env.globals['nav'] = self.nav
+        return env
+
+    def test_fragment_rendered_once_per_key(self):
+        env = self.env()
+        src = "{{ page }} {% cache section %}{{ nav(section) }}{% endcache %}"
+        pages = [('a', 'blog'), ('b', 'blog'), ('c', 'docs')]
+        out = [env.from_string(src).render(page=p, section=s) for p, s in pages]
+        self.assertEqual(['a nav:blog', 'b nav:blog', 'c nav:docs'], out)
+        self.assertEqual(['blog', 'docs'], self.calls)
+
+    def test_different_blocks_are_not_shared(self):
+        env = self.env()
+        env.from_string("{% cache 'k' %}{{ nav('x') }}{% endcache %}").render()
+        out = env.from_string("{% cache 'k' %}{{ nav('y') }}{% endcache %}").render()
+        self.assertEqual('nav:y', out)
+
+    def test_unhashable_key(self):
+        env = self.env()
+        t = env.from_string("{% cache tags %}{{ nav(tags | join(',')) }}{% endcache %}")
+        self.assertEqual('nav:a,b', t.render(tags=['a', 'b']))
+        self.assertEqual('nav:a,b', t.render(tags=['a', 'b']))
+        self.assertEqual('nav:c', t.render(tags=['c']))
+        self.assertEqual(['a,b', 'c'], self.calls)
+
+    def test_cleared_by_build(self):
+        env = self.env()
+        t = env.from_string("{% cache 'k' %}{{ nav(section) }}{% endcache %}")
+        self.assertEqual('nav:old', t.render(section='old'))
+
+        @jssg.execution_rule
+        def render(fs, inf, outf):
+            return (lambda state: fs.write(outf, t.render(section='new'))), None
+
+        indir = os.path.join(self.tmp.name, 'src')
+        outdir = os.path.join(self.tmp.name, 'build')
+        os.makedirs(indir)
+        pathlib.Path(indir, 'page.html').write_text('')
+        jssg.build(indir, outdir, [('*', (jssg.mirror_path, render))],
+                listeners={'fragment_cache': env.fragment_cache})
+        self.assertEqual('nav:new', pathlib.Path(outdir, 'page.html').read_text())
+
+    def test_bounded(self):
+        env = self.env(jssg.FragmentCache(maxsize=1))
+        t = env.from_string("{% cache s %}{{ nav(s) }}{% endcache %}")
+        for s in ('a', 'b', 'a'):
+            t.render(s=s)
+        self.assertEqual(['a', 'b', 'a'], self.calls)
+
+    def test_undefined_key(self):
+        src = "{% cache secton %}{{ nav(section) }}{% endcache %}"
+        with self.assertRaisesRegex(jinja2.UndefinedError, 'secton'):
+            self.env().from_string(src).render(section='blog')
+        with self.assertRaises(jinja2.UndefinedError):
+            Environment(extensions=[jssg.jinja_cache.FragmentCacheExtension]).from_string(src).render(section='blog', nav=self.nav)
+
+    def test_objects_as_keys(self):
+        class Page:
+            def __init__(self, n):
+                self.n = n
+        env = self.env()
+        t = env.from_string("{% cache page %}{{ page.n }}{% endcache %}")
+        self.assertEqual(['0', '1', '2', '3', '4'], [t.render(page=Page(i)) for i in range(5)])
+
+    def test_persistent_store_rejects_other_keys(self):
+        env = self.env(jssg.FragmentCache(store=self.tmp.name))
+        with self.assertRaises(TypeError):
+            env.from_string("{% cache k %}x{% endcache %}").render(k=object())
+
+    def test_persistent_store_tracks_templates(self):
+        store = os.path.join(self.tmp.name, 'store')
+        templates = os.path.join(self.tmp.name, 'templates')
+        os.makedirs(templates)
+        src = "{% cache 'k' %}{% include 'nav.html' %}{% endcache %}"
+        out = []
+        for nav in ('old', 'old', 'new'):
+            pathlib.Path(templates, 'nav.html').write_text(nav)
+            env = jssg.jinja_env(search_paths=[templates], support_rss=False,
+                    fragment_cache=jssg.FragmentCache(store=store))
+            out.append(env.from_string(src).render())
+        self.assertEqual(['old', 'old', 'new'], out)
+        # No temporary files are left behind
+        self.assertFalse([f for f in jssg.build_env.list_all_files(store) if '.tmp-' in f])
+
+    def test_persistent_store(self):
+        src = "{% cache 'k' %}{{ nav('x') }}{% endcache %}"
+        for _ in range(2):
+            env = self.env(jssg.FragmentCache(store=self.tmp.name))
+            self.assertEqual('nav:x', env.from_string(src).render())
+        self.assertEqual(['x'], self.calls)
+
+
+class TestImportTime(unittest.TestCase):
+    def importtime(self, code):
+        """Run `code` under `python -X importtime`, returning {module: cumulative us}."""
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        times = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+        return times
+
+    def test_import_is_lazy(self):
+        times = self.importtime('import jssg')
+        self.assertIn('jssg', times)
+        for name in ('jssg.jinja_utils', 'jssg.build_env', 'jinja2', 'markdown', 'dateutil'):
+            self.assertNotIn(name, times)
+
+    def test_import_time(self):
+        # Compare the cumulative time of the lazy `import jssg` with importing
+        # everything eagerly, as the package used to. Best of several runs, to
+        # reduce noise from the machine.
+        lazy = min(self.importtime('import jssg')['jssg'] for _ in range(3))
+
+        heavy = ('jssg', 'jssg.build_env', 'jssg.jinja_utils', 'jinja2', 'markdown', 'dateutil.parser')
+        code = 'import ' + ', '.join(heavy)
+        eager = min(sum(self.importtime(code).get(name, 0) for name in heavy) for _ in range(3))
+
+        self.assertLess(lazy, eager,
+                "import jssg took {}us, eager imports took {}us".format(lazy, eager))
+
+    def test_heavy_dependencies_load_on_use(self):
+        times = self.importtime('import jssg; jssg.jinja_env')
+        self.assertIn('jssg.jinja_utils', times)
+        self.assertNotIn('jinja2', times)
+
+        times = self.importtime('import jssg; jssg.format_date("2020-01-02", "%Y")')
+        self.assertIn('dateutil.parser', times)
+        self.assertNotIn('jinja2', times)
+
+
 if __name__=='__main__': unittest.main()
\ No newline at end of file